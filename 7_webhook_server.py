@@ -1,7 +1,17 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from datetime import date
-from typing import List, Dict, Any, Optional, cast
+from typing import List, Dict, Any, Iterator, Optional, cast
 
-from sapiopylib.rest.DataMgmtService import DataMgmtServer
+from flask.json.provider import DefaultJSONProvider
 from sapiopylib.rest.WebhookService import AbstractWebhookHandler, WebhookConfiguration, WebhookServerFactory
 from sapiopylib.rest.pojo.DataRecord import DataRecord
 from sapiopylib.rest.pojo.datatype.FieldDefinition import VeloxBooleanFieldDefinition, VeloxStringFieldDefinition
@@ -12,102 +22,280 @@ from sapiopylib.rest.pojo.webhook.WebhookResult import SapioWebhookResult
 from sapiopylib.rest.utils.FormBuilder import FormBuilder
 from sapiopylib.rest.utils.FoundationAccessioning import FoundationAccessionManager
 from sapiopylib.rest.utils.ProtocolUtils import ELNStepFactory
+from sapiopylib.rest.utils.autopaging import GetElnEntryRecordAutoPager
 from sapiopylib.rest.utils.Protocols import ElnExperimentProtocol, ElnEntryStep
-from waitress import serve
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class HelloWorldWebhookHandler(AbstractWebhookHandler):
+
+class _OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that parses webhook requests and serializes webhook results with orjson.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
+# Handlers only put log records on a queue; a single listener thread writes them out,
+# so request threads never contend on stdout.
+logger: logging.Logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue: queue.Queue = queue.Queue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener: QueueListener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+class _RecentInvocations:
+    """
+    Remembers which webhook invocations completed within the last few seconds, so that rules re-fired in a burst for
+    the same record only do their work once. Keys should include the calling Sapio server (URL and app GUID),
+    since record IDs are only unique within one server.
+
+    The memory is per process: with several server processes (e.g. gunicorn -w N), duplicates that reach different
+    processes are not detected.
+    """
+    ttl_seconds: float
+    max_size: int
+    _expiry_by_key: OrderedDict[Any, float]
+    _lock: threading.Lock
+
+    def __init__(self, ttl_seconds: float = 2.0, max_size: int = 10_000):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._expiry_by_key = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen_recently(self, key: Any) -> bool:
+        """
+        :param key: The identity of the invocation.
+        :return: True if an invocation with the same key completed within the TTL.
+        """
+        with self._lock:
+            expiry = self._expiry_by_key.get(key)
+            return expiry is not None and expiry > time.monotonic()
+
+    def mark(self, key: Any) -> None:
+        """
+        Record that an invocation for the given key has completed. Call this only after the work succeeded,
+        so that a failed invocation can be retried right away.
+
+        :param key: The identity of the invocation.
+        """
+        now = time.monotonic()
+        with self._lock:
+            # All entries share one TTL, so keeping marked keys at the end keeps the dict in expiry order.
+            self._expiry_by_key.pop(key, None)
+            while self._expiry_by_key:
+                oldest_key, oldest_expiry = next(iter(self._expiry_by_key.items()))
+                if oldest_expiry > now and len(self._expiry_by_key) < self.max_size:
+                    break
+                del self._expiry_by_key[oldest_key]
+            self._expiry_by_key[key] = now + self.ttl_seconds
+
+
+_recent_invocations: _RecentInvocations = _RecentInvocations()
+
+
+class _KeyedLocks:
+    """
+    Hands out one lock per key, so that concurrent invocations for the same key run one after another
+    instead of being skipped. Use this where a repeated call may carry newer data.
+
+    The locks are per process: with several server processes (e.g. gunicorn -w N), calls that reach different
+    processes are not serialized.
+    """
+    _lock: threading.Lock
+    _entries: Dict[Any, List]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Each entry is [lock, number of callers holding or waiting on it].
+        self._entries = dict()
+
+    @contextmanager
+    def hold(self, key: Any) -> Iterator[None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._entries[key]
+
+
+_experiment_rule_locks: _KeyedLocks = _KeyedLocks()
+
+
+def _get_steps_by_type(protocol: ElnExperimentProtocol) -> Dict[str, List[ElnEntryStep]]:
+    """
+    Index the steps of a protocol by the data type they attach, keeping the protocol's step order in each list.
+    This replaces repeated get_first_step_of_type/get_next_step scans with dictionary and index lookups,
+    so it only pays off when a handler needs more than one step of a type.
+    Only exact data type names are indexed, so ELN base types (e.g. ELNSampleDetail) must use the protocol methods.
+    """
+    steps_by_type: Dict[str, List[ElnEntryStep]] = dict()
+    for step in protocol.get_sorted_step_list():
+        for data_type_name in step.get_data_type_names():
+            steps_by_type.setdefault(data_type_name, []).append(step)
+    return steps_by_type
+
+
+class StatelessWebhookHandler(AbstractWebhookHandler):
+    """
+    Base class of the handlers below. None of them keep per-request state on the instance, so the views that
+    WebhookServerFactory.configure_flask_app registers create each handler once instead of once per request.
+    """
+    init_every_request = False
+
+
+class HelloWorldWebhookHandler(StatelessWebhookHandler):
     """
     Prints "Hello World" in the python console whenever the webhook handler is invoked.
     """
 
     def run(self, context: SapioWebhookContext) -> SapioWebhookResult:
-        print("Hello World!")
+        logger.info("Hello World!")
         return SapioWebhookResult(True)
 
 
-class UserFeedbackHandler(AbstractWebhookHandler):
+def _build_feedback_request() -> FormEntryDialogRequest:
+    """
+    Build the feedback form popup. The form never changes between calls, so it is built once at import time.
+    """
+    form_builder: FormBuilder = FormBuilder()
+
+    feeling_field = VeloxBooleanFieldDefinition(form_builder.get_data_type_name(), 'Feeling',
+                                                "Are you feeling well?", default_value=False)
+    feeling_field.required = True
+    feeling_field.editable = True
+
+    form_builder.add_field(feeling_field)
+
+    comments_field = VeloxStringFieldDefinition(form_builder.get_data_type_name(), 'Comments',
+                                                "Additional Comments", max_length=2000)
+    comments_field.editable = True
+
+    form_builder.add_field(comments_field)
+
+    temp_dt = form_builder.get_temporary_data_type()
+    return FormEntryDialogRequest("Feedback", "Please provide us with some feedback!", temp_dt)
+
+
+_FEEDBACK_REQUEST: FormEntryDialogRequest = _build_feedback_request()
+_FEEDBACK_FELT_GOOD_TEXT = "User felt very good! Nothing to do here..."
+_FEEDBACK_CANCELLED_LOG = "Cancelled."
+_FEEDBACK_CANCELLED_TEXT = "You have Cancelled!"
+
+
+class UserFeedbackHandler(StatelessWebhookHandler):
     """
     Ask user some questions, get response back.
     """
 
-    def run(self, context: SapioWebhookContext) -> SapioWebhookResult:
-        if context.client_callback_result is not None:
-            # This is Round 2, user has answered the feedback form. We are parsing the results...
-            form_result: Optional[FormEntryDialogResult] = cast(Optional[FormEntryDialogResult],
-                                                                context.client_callback_result)
-            if not form_result.user_cancelled:
-                response_map: Dict[str, Any] = form_result.user_response_map
-                feeling: bool = response_map.get('Feeling')
-                comments: str = response_map.get('Comments')
-
-                msg: str
-                if feeling:
-                    msg = "User felt very good! Nothing to do here..."
-                else:
-                    msg = "=_= User didn't feel very good. The comment left was: " + str(comments)
-
-                print(msg)
-                # Display text sent over will be a toastr on the web client in Sapio.
-                return SapioWebhookResult(True, client_callback_request=None, display_text=msg)
-            else:
-                print("Cancelled.")
-                return SapioWebhookResult(True, display_text="You have Cancelled!")
-            
-        else:
-            # This is Round 1, user hasn't done anything we are just telling Sapio Platform to display a form...
-            form_builder: FormBuilder = FormBuilder()
+    def _round_1(self, context: SapioWebhookContext) -> SapioWebhookResult:
+        # This is Round 1, user hasn't done anything we are just telling Sapio Platform to display a form...
+        return SapioWebhookResult(True, client_callback_request=_FEEDBACK_REQUEST)
 
-            feeling_field = VeloxBooleanFieldDefinition(form_builder.get_data_type_name(), 'Feeling',
-                                                        "Are you feeling well?", default_value=False)
-            feeling_field.required = True
-            feeling_field.editable = True
+    def _round_2_cancelled(self, context: SapioWebhookContext) -> SapioWebhookResult:
+        logger.info(_FEEDBACK_CANCELLED_LOG)
+        return SapioWebhookResult(True, display_text=_FEEDBACK_CANCELLED_TEXT)
 
-            form_builder.add_field(feeling_field)
+    def _round_2_answered(self, context: SapioWebhookContext) -> SapioWebhookResult:
+        # This is Round 2, user has answered the feedback form. We are parsing the results...
+        form_result: FormEntryDialogResult = cast(FormEntryDialogResult, context.client_callback_result)
+        response_map: Dict[str, Any] = form_result.user_response_map
+        feeling: bool = response_map.get('Feeling')
 
-            comments_field = VeloxStringFieldDefinition(form_builder.get_data_type_name(), 'Comments',
-                                                        "Additional Comments", max_length=2000)
-            comments_field.editable = True
+        msg: str
+        if feeling:
+            msg = _FEEDBACK_FELT_GOOD_TEXT
+        else:
+            msg = f"=_= User didn't feel very good. The comment left was: {response_map.get('Comments')}"
+
+        logger.info(msg)
+        # Display text sent over will be a toastr on the web client in Sapio.
+        return SapioWebhookResult(True, client_callback_request=None, display_text=msg)
 
-            form_builder.add_field(comments_field)
+    # Keyed by (has the user answered the form yet, did the user cancel it).
+    _ROUNDS = {
+        (False, False): _round_1,
+        (True, True): _round_2_cancelled,
+        (True, False): _round_2_answered
+    }
 
-            temp_dt = form_builder.get_temporary_data_type()
-            request = FormEntryDialogRequest("Feedback", "Please provide us with some feedback!", temp_dt)
-            return SapioWebhookResult(True, client_callback_request=request)
+    def run(self, context: SapioWebhookContext) -> SapioWebhookResult:
+        form_result: Optional[FormEntryDialogResult] = cast(Optional[FormEntryDialogResult],
+                                                            context.client_callback_result)
+        key = (form_result is not None, form_result is not None and bool(form_result.user_cancelled))
+        return self._ROUNDS[key](self, context)
 
 
-class NewGooOnSaveRuleHandler(AbstractWebhookHandler):
+class NewGooOnSaveRuleHandler(StatelessWebhookHandler):
     """
     When a new "Goo" data type record is created, run this rule.
     """
 
     def run(self, context: SapioWebhookContext) -> SapioWebhookResult:
-        print("New Goo '" + str(context.data_record))
+        key = None
+        if context.data_record is not None:
+            key = (NewGooOnSaveRuleHandler, context.user.url, context.user.guid, context.data_record.record_id)
+        if key is None or not _recent_invocations.seen_recently(key):
+            logger.info("New Goo '%s", context.data_record)
+            if key is not None:
+                _recent_invocations.mark(key)
         return SapioWebhookResult(True, display_text="New Goo!")
 
 
-class ExperimentRuleHandler(AbstractWebhookHandler):
+class ExperimentRuleHandler(StatelessWebhookHandler):
     """
     The entry and notebook that triggered the rule will be on the context.
     """
 
     def run(self, context: SapioWebhookContext) -> SapioWebhookResult:
-        print("Experiment Entries of Rule: " + ','.join([entry.entry_name for entry in context.experiment_entry_list]))
-        print("Notebook Experiment of Rule: " + context.eln_experiment.notebook_experiment_name)
+        # A repeated save may carry newer entry data, so bursts for the same entries are serialized, never skipped.
+        with _experiment_rule_locks.hold((context.user.url, context.user.guid,
+                                          context.eln_experiment.notebook_experiment_id,
+                                          tuple(entry.entry_id for entry in context.experiment_entry_list))):
+            return self._run(context)
 
-        entry = context.experiment_entry_list[0]
+    def _run(self, context: SapioWebhookContext) -> SapioWebhookResult:
+        logger.info("Experiment Entries of Rule: %s",
+                    ','.join(entry.entry_name for entry in context.experiment_entry_list))
+        logger.info("Notebook Experiment of Rule: %s", context.eln_experiment.notebook_experiment_name)
 
-        eln_manager = DataMgmtServer.get_eln_manager(context.user)
+        entry = context.experiment_entry_list[0]
 
-        records = eln_manager.get_data_records_for_entry(context.eln_experiment.notebook_experiment_id, entry.entry_id)
+        # The auto-pager visits every page of the entry's records, not just the first page that
+        # get_data_records_for_entry returns on its own. That costs one REST call per page, and the pager builds
+        # its own ELN and data record managers instead of reusing context.eln_manager.
+        records = GetElnEntryRecordAutoPager(context.eln_experiment.notebook_experiment_id, entry.entry_id,
+                                             context.user)
 
-        print("Record Values were: " + ','.join([str(record.get_field_value('NewField'))
-                                                 for record in records.result_list]))
+        logger.info("Record Values were: %s", ','.join(f"{record.get_field_value('NewField')}" for record in records))
         
         return SapioWebhookResult(True)
 
 
-class ElnSampleAliquotRatioCountHandler(AbstractWebhookHandler):
+class ElnSampleAliquotRatioCountHandler(StatelessWebhookHandler):
     """
     Find the source sample table in the notebook experiment. Count how many samples there are.
     Then, see if there are aliquots. If there are aliquots, print aliquot/sample ratio.
@@ -117,26 +305,29 @@ class ElnSampleAliquotRatioCountHandler(AbstractWebhookHandler):
     def run(self, context: SapioWebhookContext) -> SapioWebhookResult:
         active_protocol: Optional[ElnExperimentProtocol] = context.active_protocol
 
-        sample_step = active_protocol.get_first_step_of_type('Sample')
-        if sample_step is None:
+        sample_steps: List[ElnEntryStep] = _get_steps_by_type(active_protocol).get('Sample', [])
+        if not sample_steps:
             return SapioWebhookResult(True, display_text='There are no source sample table.')
+        sample_step = sample_steps[0]
         
         source_sample_records: List[DataRecord] = sample_step.get_records()
         source_sample_record_count = len(source_sample_records)
+        if source_sample_record_count == 0:
+            return SapioWebhookResult(True, display_text='Source sample table is empty.')
 
         # Find the next sample table after the current source sample table,
         # excludes the sample table and everything before.
-        aliquot_step = active_protocol.get_next_step(sample_step, 'Sample')
+        aliquot_step = sample_steps[1] if len(sample_steps) > 1 else None
         if aliquot_step is None:
             return SapioWebhookResult(True, display_text='There are no aliquot sample table.')
         
         aliquot_sample_record_count = len(aliquot_step.get_records())
 
-        return SapioWebhookResult(True, display_text='The aliquot to sample ratio is: ' +
-                                                     str(aliquot_sample_record_count / source_sample_record_count))
+        return SapioWebhookResult(True, display_text=f'The aliquot to sample ratio is: '
+                                                     f'{aliquot_sample_record_count / source_sample_record_count:.3f}')
 
 
-class ElnStepCreationHandler(AbstractWebhookHandler):
+class ElnStepCreationHandler(StatelessWebhookHandler):
     """
     Here are examples on how to use the protocol/step interfaces to easily create new steps in ELN.
     """
@@ -145,10 +336,10 @@ class ElnStepCreationHandler(AbstractWebhookHandler):
         active_protocol: Optional[ElnExperimentProtocol] = context.active_protocol
 
         # We will create a Request form.
-        request_record = context.data_record_manager.add_data_record('Request')
-        request_record.set_field_value('RequestId', 'Python Webhook Demo Request ' + str(date.today()))
-
-        context.data_record_manager.commit_data_records([request_record])
+        # Create the record with its field values in one call, rather than adding it and then committing the change.
+        request_record = context.data_record_manager.add_data_records_with_data('Request', [{
+            'RequestId': f'Python Webhook Demo Request {date.today()}'
+        }])[0]
 
         ELNStepFactory.create_form_step(active_protocol, 'Request Data', 'Request', request_record)
 
@@ -161,7 +352,7 @@ class ElnStepCreationHandler(AbstractWebhookHandler):
         return SapioWebhookResult(True)
 
 
-class ElnSampleCreationHandler(AbstractWebhookHandler):
+class ElnSampleCreationHandler(StatelessWebhookHandler):
     """
     Create a sample step if not exists, and then accession 8 blood samples.
     """
@@ -173,25 +364,22 @@ class ElnSampleCreationHandler(AbstractWebhookHandler):
         if sample_step is None:
             sample_step = ELNStepFactory.create_table_step(active_protocol, 'Samples', 'Sample')
 
-        sample_fields: List[Dict[str, Any]] = []
+        # Only accession once the sample step exists, so a failure above does not use up sample IDs.
         num_samples = 8
         accession_man: FoundationAccessionManager = FoundationAccessionManager(context.user)
         sample_id_list: List[str] = accession_man.get_accession_with_config_list('Sample', 'SampleId', num_samples)
+        sample_fields: List[Dict[str, Any]] = [{'ExemplarSampleType': 'Blood', 'SampleId': sample_id}
+                                               for sample_id in sample_id_list]
 
-        for sample_id in sample_id_list:
-            sample_field = {
-                'ExemplarSampleType': 'Blood',
-                'SampleId': sample_id
-            }
-            sample_fields.append(sample_field)
-            
+        # All samples are created in a single call. Do not coalesce these writes across concurrent webhook calls:
+        # each invocation carries its own webhook API token, so the records belong to that invocation only.
         sample_records = context.data_record_manager.add_data_records_with_data('Sample', sample_fields)
         context.eln_manager.add_records_to_table_entry(active_protocol.eln_experiment.notebook_experiment_id,
                                                        sample_step.eln_entry.entry_id, sample_records)
         return SapioWebhookResult(True)
 
 
-class BarChartDashboardCreationHandler(AbstractWebhookHandler):
+class BarChartDashboardCreationHandler(StatelessWebhookHandler):
     """
     Provide a bar chart for a sample table where x-axis is sample ID and y-axis is concentration.
     """
@@ -214,7 +402,10 @@ class BarChartDashboardCreationHandler(AbstractWebhookHandler):
 # In this example, we are listening to 8090. So the endpoint URL to be configured in Sapio is:
 # http://[webhook_server_hostname]:8090/hello_world
 
-config: WebhookConfiguration = WebhookConfiguration(verify_sapio_cert=False, debug=True)
+# Debug mode and skipping Sapio certificate checks are for local development only: set DEBUG=1 and VERIFY_SAPIO_CERT=0.
+debug: bool = os.environ.get('DEBUG') == '1'
+verify_sapio_cert: bool = os.environ.get('VERIFY_SAPIO_CERT', '1') == '1'
+config: WebhookConfiguration = WebhookConfiguration(verify_sapio_cert=verify_sapio_cert, debug=debug)
 config.register('/hello_world', HelloWorldWebhookHandler)
 config.register('/feedback_form', UserFeedbackHandler)
 config.register('/new_goo', NewGooOnSaveRuleHandler)
@@ -225,10 +416,23 @@ config.register('/eln/sample_creation', ElnSampleCreationHandler)
 config.register('/eln/bar_chart_creation', BarChartDashboardCreationHandler)
 
 app = WebhookServerFactory.configure_flask_app(app=None, config=config)
+if not debug:
+    # Silence the per-request access log of Flask's development server (app.run).
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+if orjson is not None:
+    # Sapio webhook payloads are plain JSON, so the faster orjson codec can replace the standard library one.
+    app.json = _OrjsonProvider(app)
 # UNENCRYPTED! This should not be used in production. You should give the "app" a ssl_context or set up a reverse-proxy.
 
 # Dev Mode:
 # app.run(host="0.0.0.0", port=8090)
 
 # Production Mode
-serve(app, host="0.0.0.0", port=8090)
+# "app" is a module-level WSGI callable, so it can also be run under gunicorn's pre-fork workers to use every core:
+# gunicorn -w $(nproc) -k gthread --threads 8 -b 0.0.0.0:8090 7_webhook_server:app
+
+if __name__ == '__main__':
+    from waitress import serve
+    # Handlers are I/O-bound on Sapio REST calls, so run well more threads than cores (2-4x is a good start).
+    serve(app, host="0.0.0.0", port=8090, threads=int(os.environ.get('WAITRESS_THREADS', 32)),
+          connection_limit=1000, channel_timeout=30, asyncore_use_poll=True, ident=None)